@@ -7,11 +7,18 @@ Descripción: Bot con sistema de créditos, auto-registro de usuarios y comandos
 """
 
 import os
+import time
+import queue
+import atexit
+import asyncio
 import logging
+import functools
+from logging.handlers import QueueHandler, QueueListener
+from collections import namedtuple
 from datetime import datetime, timedelta
+from cachetools import TTLCache
 from dotenv import load_dotenv
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg_pool import AsyncConnectionPool
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, ContextTypes, ConversationHandler, MessageHandler, filters
 from telegram.constants import ParseMode
@@ -25,210 +32,336 @@ CHANNEL_ID = int(os.getenv('CHANNEL_ID'))
 DATABASE_URL = os.getenv('DATABASE_URL')
 PRICE_PER_SEARCH = int(os.getenv('PRICE_PER_SEARCH', '5'))
 INITIAL_CREDITS = 100  # Créditos iniciales para nuevos usuarios
-
-logging.basicConfig(level=logging.INFO)
+DB_POOL_SIZE = 10  # Conexiones máximas; también limita los updates en paralelo
+CACHE_TTL = 60  # Segundos que se cachean usuarios y precio
+SEARCH_LOG_BATCH_SIZE = 500  # Máximo de búsquedas por INSERT en lote
+SEARCH_LOG_FLUSH_INTERVAL = 2  # Segundos máximos antes de escribir un lote
+SCHEMA_LOCK_ID = 1234567  # Advisory lock que serializa init_db entre instancias
+
+# Los handlers sólo encolan; un hilo aparte escribe a la consola
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # ==================== BASE DE DATOS ====================
+User = namedtuple('User', 'user_id username first_name last_name credits expiry_date created_at is_active')
+USER_COLUMNS = ', '.join(User._fields)
+
 class Database:
     def __init__(self):
-        self.init_db()
+        # Las consultas recurrentes usan prepare=True: cada conexión del pool
+        # las prepara en el servidor la primera vez y reutiliza el plan
+        self.pool = AsyncConnectionPool(DATABASE_URL, min_size=2, max_size=DB_POOL_SIZE, open=False)
+        self._user_cache = TTLCache(maxsize=10_000, ttl=CACHE_TTL)
+        self._price_cache = (None, 0.0)  # (precio, expira_en)
+        self._log_queue = asyncio.Queue()
+        self._log_task = None
+
+    async def open(self):
+        """Abre el pool de conexiones, inicializa las tablas y arranca el escritor de logs"""
+        await self.pool.open()
+        await self.init_db()
+        self._log_task = asyncio.create_task(self._log_writer())
+
+    async def close(self):
+        """Vacía los logs pendientes y cierra el pool de conexiones"""
+        if self._log_task:
+            await self._log_queue.put(None)
+            await self._log_task
+        await self.pool.close()
+
+    async def _log_writer(self):
+        """Escribe en lotes las búsquedas encoladas por log_search"""
+        while True:
+            rows = [await self._log_queue.get()]
+            self._drain_log_queue(rows)
+            if rows[-1] is not None and len(rows) < SEARCH_LOG_BATCH_SIZE:
+                # Lote incompleto: esperar una sola vez a que lleguen más
+                await asyncio.sleep(SEARCH_LOG_FLUSH_INTERVAL)
+                self._drain_log_queue(rows)
+
+            stop = rows[-1] is None
+            rows = [row for row in rows if row is not None]
+            if rows:
+                await self._write_searches(rows)
+            if stop:
+                return
+
+    def _drain_log_queue(self, rows):
+        """Pasa a rows lo que ya esté en la cola, sin esperar"""
+        while rows[-1] is not None and len(rows) < SEARCH_LOG_BATCH_SIZE:
+            try:
+                rows.append(self._log_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                return
+
+    async def _write_searches(self, rows):
+        """Guarda un lote de búsquedas; si falla, las reintenta una a una"""
+        query = '''
+            INSERT INTO searches (user_id, search_term, results_count, credits_used)
+            VALUES (%s, %s, %s, %s)
+        '''
+        try:
+            async with self.pool.connection() as conn, conn.cursor() as cur:
+                await cur.executemany(query, rows)
+            return
+        except Exception as e:
+            logger.error(f"Error al guardar {len(rows)} búsquedas en lote, reintentando una a una: {e}")
 
-    def get_connection(self):
-        """Obtiene conexión a PostgreSQL"""
-        return psycopg2.connect(DATABASE_URL)
+        try:
+            async with self.pool.connection() as conn:
+                for row in rows:
+                    try:
+                        # Cada fila se confirma en su propia transacción: una fila mala no aborta el resto
+                        async with conn.transaction():
+                            await conn.execute(query, row)
+                    except Exception as e:
+                        logger.error(f"Búsqueda descartada {row}: {e}")
+        except Exception as e:
+            logger.error(f"Error al guardar {len(rows)} búsquedas: {e}")
 
-    def init_db(self):
+    async def init_db(self):
         """Inicializa las tablas de la base de datos"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        
-        # Tabla de usuarios
-        cur.execute('''CREATE TABLE IF NOT EXISTS users (
-            user_id BIGINT PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            credits INT DEFAULT 100,
-            expiry_date TIMESTAMP,
-            created_at TIMESTAMP DEFAULT NOW(),
-            is_active BOOLEAN DEFAULT TRUE
-        )''')
-
-        # Tabla de búsquedas (logs)
-        cur.execute('''CREATE TABLE IF NOT EXISTS searches (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT REFERENCES users(user_id),
-            search_term TEXT,
-            results_count INT,
-            credits_used INT,
-            created_at TIMESTAMP DEFAULT NOW()
-        )''')
-
-        # Tabla de configuración
-        cur.execute('''CREATE TABLE IF NOT EXISTS config (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )''')
-
-        # Insertar precio por defecto
-        cur.execute("""
-            INSERT INTO config (key, value) 
-            VALUES ('price_per_search', %s) 
-            ON CONFLICT (key) DO UPDATE SET value = %s
-        """, (str(PRICE_PER_SEARCH), str(PRICE_PER_SEARCH)))
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        async with self.pool.connection() as conn:
+            # Sólo una instancia crea el esquema; el lock se libera con el commit
+            cur = await conn.execute('SELECT pg_try_advisory_xact_lock(%s)', (SCHEMA_LOCK_ID,))
+            if not (await cur.fetchone())[0]:
+                # Otra instancia lo está creando: esperar a que termine
+                await conn.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_LOCK_ID,))
+                logger.info("✓ Base de datos inicializada por otra instancia")
+                return
+
+            await self._create_schema(conn)
+
         logger.info("✓ Base de datos inicializada")
 
-    def user_exists(self, user_id):
-        """Verifica si un usuario existe"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        cur.execute('SELECT user_id FROM users WHERE user_id = %s', (user_id,))
-        exists = cur.fetchone() is not None
-        cur.close()
-        conn.close()
-        return exists
-
-    def register_user(self, user_id, username, first_name, last_name, credits=100, days=30):
-        """Registra un nuevo usuario en la base de datos"""
-        conn = self.get_connection()
-        cur = conn.cursor()
+    async def _create_schema(self, conn):
+        """Crea tablas e índices y fija el precio por defecto"""
+        # En modo pipeline todas las sentencias viajan en un solo round trip
+        async with conn.pipeline(), conn.cursor() as cur:
+            # Tabla de usuarios
+            await cur.execute('''CREATE TABLE IF NOT EXISTS users (
+                user_id BIGINT PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                credits INT DEFAULT 100,
+                expiry_date TIMESTAMP,
+                created_at TIMESTAMP DEFAULT NOW(),
+                is_active BOOLEAN DEFAULT TRUE
+            )''')
+
+            # Tabla de búsquedas (logs)
+            await cur.execute('''CREATE TABLE IF NOT EXISTS searches (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT REFERENCES users(user_id),
+                search_term TEXT,
+                results_count INT,
+                credits_used INT,
+                created_at TIMESTAMP DEFAULT NOW()
+            )''')
+
+            # Índice de la FK searches.user_id -> users
+            await cur.execute('''CREATE INDEX IF NOT EXISTS searches_user_id_idx
+                ON searches (user_id)''')
+
+            # Índices para /stats (BRIN: mínimo tamaño en una tabla append-only)
+            await cur.execute('''CREATE INDEX IF NOT EXISTS searches_created_at_idx
+                ON searches USING BRIN (created_at)''')
+            await cur.execute('''CREATE INDEX IF NOT EXISTS users_active_idx
+                ON users (is_active) WHERE is_active''')
+
+            # Tabla de configuración
+            await cur.execute('''CREATE TABLE IF NOT EXISTS config (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )''')
+
+            # Insertar precio por defecto
+            await cur.execute("""
+                INSERT INTO config (key, value) 
+                VALUES ('price_per_search', %s) 
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+            """, (str(PRICE_PER_SEARCH),))
+
+    async def touch_user(self, user_id, username, first_name, last_name, credits=100, days=30):
+        """Registra al usuario si es nuevo o refresca sus datos de Telegram.
+
+        Devuelve (usuario, es_nuevo) con un único upsert.
+        """
         expiry = datetime.now() + timedelta(days=days)
-        
-        try:
-            cur.execute('''
+
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(f'''
                 INSERT INTO users (user_id, username, first_name, last_name, credits, expiry_date, is_active)
                 VALUES (%s, %s, %s, %s, %s, %s, TRUE)
-                ON CONFLICT (user_id) DO UPDATE 
-                SET credits = %s, expiry_date = %s, is_active = TRUE
-            ''', (user_id, username, first_name, last_name, credits, expiry, credits, expiry))
-            conn.commit()
+                ON CONFLICT (user_id) DO UPDATE
+                SET username = EXCLUDED.username,
+                    first_name = EXCLUDED.first_name,
+                    last_name = EXCLUDED.last_name
+                RETURNING {USER_COLUMNS}, (xmax = 0)
+            ''', (user_id, username, first_name, last_name, credits, expiry), prepare=True)
+            *row, was_inserted = await cur.fetchone()
+
+        user = self._user_cache[user_id] = User(*row)
+        if was_inserted:
             logger.info(f"✓ Usuario registrado: {user_id} (@{username})")
-            return True
+        return user, was_inserted
+
+    async def register_user(self, user_id, username, first_name, last_name, credits=100, days=30):
+        """Registra un nuevo usuario y devuelve su fila (None si falla)"""
+        expiry = datetime.now() + timedelta(days=days)
+
+        try:
+            async with self.pool.connection() as conn, conn.cursor() as cur:
+                await cur.execute(f'''
+                    INSERT INTO users (user_id, username, first_name, last_name, credits, expiry_date, is_active)
+                    VALUES (%s, %s, %s, %s, %s, %s, TRUE)
+                    ON CONFLICT (user_id) DO UPDATE 
+                    SET credits = %s, expiry_date = %s, is_active = TRUE
+                    RETURNING {USER_COLUMNS}
+                ''', (user_id, username, first_name, last_name, credits, expiry, credits, expiry), prepare=True)
+                user = User(*await cur.fetchone())
+            self._user_cache[user_id] = user
+            logger.info(f"✓ Usuario registrado: {user_id} (@{username})")
+            return user
         except Exception as e:
             logger.error(f"Error al registrar usuario: {e}")
-            return False
-        finally:
-            cur.close()
-            conn.close()
-
-    def get_user(self, user_id):
-        """Obtiene información del usuario"""
-        conn = self.get_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('SELECT * FROM users WHERE user_id = %s', (user_id,))
-        user = cur.fetchone()
-        cur.close()
-        conn.close()
+            return None
+
+    async def get_user(self, user_id):
+        """Obtiene información del usuario (cacheada por CACHE_TTL segundos)"""
+        user = self._user_cache.get(user_id)
+        if user is not None:
+            return user
+
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(f'SELECT {USER_COLUMNS} FROM users WHERE user_id = %s', (user_id,), prepare=True)
+            row = await cur.fetchone()
+
+        if row is None:
+            return None
+        user = self._user_cache[user_id] = User(*row)
         return user
 
-    def deduct_credits(self, user_id, amount):
-        """Deduce créditos de un usuario"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        cur.execute('UPDATE users SET credits = credits - %s WHERE user_id = %s', 
-                   (amount, user_id))
-        conn.commit()
-        cur.close()
-        conn.close()
-
-    def add_credits(self, user_id, amount):
-        """Agrega créditos a un usuario"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        cur.execute('UPDATE users SET credits = credits + %s WHERE user_id = %s', 
-                   (amount, user_id))
-        conn.commit()
-        cur.close()
-        conn.close()
-
-    def remove_user(self, user_id):
+    async def add_credits(self, user_id, amount):
+        """Agrega créditos a un usuario y devuelve su nuevo saldo (None si no existe)"""
+        async with self.pool.connection() as conn:
+            cur = await conn.execute('UPDATE users SET credits = credits + %s WHERE user_id = %s RETURNING credits', 
+                                     (amount, user_id), prepare=True)
+            result = await cur.fetchone()
+        if result is None:
+            return None
+        self._set_cached_credits(user_id, result[0], amount)
+        return result[0]
+
+    def _set_cached_credits(self, user_id, credits, delta):
+        """Aplica al usuario cacheado el saldo devuelto por un UPDATE de +delta.
+
+        Con updates concurrentes los RETURNING pueden llegar desordenados: si
+        el saldo cacheado no es el previo a esta escritura, se descarta.
+        """
+        user = self._user_cache.get(user_id)
+        if user is None:
+            return
+        if user.credits + delta == credits:
+            self._user_cache[user_id] = user._replace(credits=credits)
+        else:
+            self._user_cache.pop(user_id, None)
+
+    async def remove_user(self, user_id):
         """Desactiva un usuario"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        cur.execute('UPDATE users SET is_active = FALSE WHERE user_id = %s', 
-                   (user_id,))
-        conn.commit()
-        cur.close()
-        conn.close()
-
-    def set_price(self, price):
-        """Actualiza el precio por búsqueda"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        cur.execute("UPDATE config SET value = %s WHERE key = 'price_per_search'", 
-                   (str(price),))
-        conn.commit()
-        cur.close()
-        conn.close()
-
-    def get_price(self):
-        """Obtiene el precio actual por búsqueda"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM config WHERE key = 'price_per_search'")
-        result = cur.fetchone()
-        cur.close()
-        conn.close()
-        return int(result[0]) if result else PRICE_PER_SEARCH
-
-    def log_search(self, user_id, search_term, results_count):
-        """Registra una búsqueda en la base de datos"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        cur.execute('''
-            INSERT INTO searches (user_id, search_term, results_count, credits_used)
-            VALUES (%s, %s, %s, %s)
-        ''', (user_id, search_term, results_count, self.get_price()))
-        conn.commit()
-        cur.close()
-        conn.close()
+        async with self.pool.connection() as conn:
+            await conn.execute('UPDATE users SET is_active = FALSE WHERE user_id = %s', 
+                               (user_id,), prepare=True)
+        self._user_cache.pop(user_id, None)
 
-    def get_stats(self):
+    async def set_price(self, price):
+        """Actualiza el precio por búsqueda"""
+        async with self.pool.connection() as conn:
+            await conn.execute("UPDATE config SET value = %s WHERE key = 'price_per_search'", 
+                               (str(price),), prepare=True)
+        self._price_cache = (None, 0.0)
+
+    async def get_price(self):
+        """Obtiene el precio actual por búsqueda (cacheado por CACHE_TTL segundos)"""
+        price, expires_at = self._price_cache
+        if price is not None and expires_at > time.monotonic():
+            return price
+
+        async with self.pool.connection() as conn:
+            cur = await conn.execute("SELECT value FROM config WHERE key = 'price_per_search'", prepare=True)
+            result = await cur.fetchone()
+        price = int(result[0]) if result else PRICE_PER_SEARCH
+        self._price_cache = (price, time.monotonic() + CACHE_TTL)
+        return price
+
+    async def charge_search(self, user_id, search_term, results_count):
+        """Decide si el usuario puede buscar y lo cobra en una sola sentencia.
+
+        Devuelve (estado, créditos, precio), donde estado es 'ok', 'inactive',
+        'expired' o 'nofunds'; sólo con 'ok' se descuentan los créditos y se
+        encola la búsqueda para el log. None si el usuario no está registrado.
+        """
+        async with self.pool.connection() as conn:
+            cur = await conn.execute('''
+                WITH p AS (
+                    SELECT COALESCE(
+                        (SELECT value::int FROM config WHERE key = 'price_per_search'), %s
+                    ) AS price
+                ), s AS (
+                    SELECT u.user_id, u.credits,
+                        CASE
+                            WHEN NOT u.is_active THEN 'inactive'
+                            WHEN u.expiry_date < %s THEN 'expired'
+                            WHEN u.credits < p.price THEN 'nofunds'
+                            ELSE 'ok'
+                        END AS status
+                    FROM users u, p
+                    WHERE u.user_id = %s
+                ), d AS (
+                    UPDATE users SET credits = users.credits - p.price
+                    FROM p, s
+                    WHERE users.user_id = s.user_id AND s.status = 'ok' AND users.credits >= p.price
+                    RETURNING users.credits
+                )
+                SELECT
+                    CASE WHEN s.status = 'ok' AND d.credits IS NULL THEN 'nofunds' ELSE s.status END,
+                    COALESCE(d.credits, s.credits),
+                    p.price
+                FROM s CROSS JOIN p LEFT JOIN d ON TRUE
+            ''', (PRICE_PER_SEARCH, datetime.now(), user_id), prepare=True)
+            result = await cur.fetchone()
+
+        if result and result[0] == 'ok':
+            self._set_cached_credits(user_id, result[1], -result[2])
+            await self.log_search(user_id, search_term, results_count, result[2])
+        return result
+
+    async def log_search(self, user_id, search_term, results_count, credits_used):
+        """Encola una búsqueda; _log_writer la guarda en el próximo lote"""
+        await self._log_queue.put((user_id, search_term, results_count, credits_used))
+
+    async def get_stats(self):
         """Obtiene estadísticas del sistema"""
-        conn = self.get_connection()
-        cur = conn.cursor()
-        cur.execute('SELECT COUNT(*) FROM users WHERE is_active = TRUE')
-        user_count = cur.fetchone()[0]
-        cur.execute('SELECT COUNT(*) FROM searches WHERE DATE(created_at) = CURRENT_DATE')
-        search_count = cur.fetchone()[0]
-        cur.close()
-        conn.close()
+        async with self.pool.connection() as conn:
+            cur = await conn.execute('''
+                SELECT
+                    (SELECT COUNT(*) FROM users WHERE is_active),
+                    (SELECT COUNT(*) FROM searches
+                     WHERE created_at >= CURRENT_DATE AND created_at < CURRENT_DATE + INTERVAL '1 day')
+            ''', prepare=True)
+            user_count, search_count = await cur.fetchone()
         return user_count, search_count
 
 db = Database()
 
-# ==================== COMANDOS DE USUARIO ====================
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Comando /start - Registro automático y bienvenida"""
-    user = update.effective_user
-    user_id = user.id
-    username = user.username or "Sin usuario"
-    first_name = user.first_name or "Usuario"
-    last_name = user.last_name or ""
-
-    # Verificar si el usuario ya está registrado
-    existing_user = db.get_user(user_id)
+# ==================== PLANTILLAS ====================
 
-    if not existing_user:
-        # Registrar nuevo usuario
-        db.register_user(
-            user_id=user_id,
-            username=username,
-            first_name=first_name,
-            last_name=last_name,
-            credits=INITIAL_CREDITS,
-            days=30
-        )
-        user_info = db.get_user(user_id)
-        
-        # Mensaje de bienvenida para nuevo usuario
-        welcome_msg = f"""
+WELCOME_NEW_TEMPLATE = """
 🎉 <b>¡Bienvenido {first_name}!</b>
 
 Has sido registrado automáticamente en el sistema.
@@ -236,8 +369,8 @@ Has sido registrado automáticamente en el sistema.
 👤 <b>Tu Información:</b>
 🔑 ID: <code>{user_id}</code>
 👤 Usuario: @{username}
-💳 Créditos Iniciales: {INITIAL_CREDITS}
-📅 Acceso por: 30 días
+💳 Créditos Iniciales: {credits}
+📅 Acceso por: {days} días
 
 📋 <b>Comandos Disponibles:</b>
 /cmds - Ver todos los comandos
@@ -246,57 +379,24 @@ Has sido registrado automáticamente en el sistema.
 /live - Buscar en el canal
 
 ¿Necesitas ayuda? Escribe /cmds
-        """
-    else:
-        # Usuario ya existe
-        expiry = datetime.fromisoformat(str(existing_user['expiry_date']))
-        
-        if not existing_user['is_active']:
-            await update.message.reply_text(
-                "❌ Tu acceso ha sido desactivado.\n"
-                "Contacta al administrador.",
-                parse_mode=ParseMode.HTML
-            )
-            return
-
-        if datetime.now() > expiry:
-            await update.message.reply_text(
-                "⏰ Tu acceso ha expirado.\n"
-                "Contacta al administrador para renovar.",
-                parse_mode=ParseMode.HTML
-            )
-            return
+"""
 
-        welcome_msg = f"""
+WELCOME_BACK_TEMPLATE = """
 👋 <b>¡Bienvenido de vuelta {first_name}!</b>
 
-🔑 ID: <code>{user_id}</code>
-💳 Créditos: {existing_user['credits']}
-📅 Expira: {expiry.strftime('%d/%m/%Y')}
+🔑 ID: <code>{user.user_id}</code>
+💳 Créditos: {user.credits}
+📅 Expira: {user.expiry_date:%d/%m/%Y}
 
 Escribe /cmds para ver los comandos disponibles
-        """
-
-    await update.message.reply_text(welcome_msg, parse_mode=ParseMode.HTML)
-
-async def cmds(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Comando /cmds - Muestra todos los comandos disponibles"""
-    user_id = update.effective_user.id
-    user = db.get_user(user_id)
-
-    if not user:
-        await update.message.reply_text(
-            "❌ No estás registrado. Usa /start primero.",
-            parse_mode=ParseMode.HTML
-        )
-        return
+"""
 
-    commands_msg = f"""
+CMDS_TEMPLATE = """
 📋 <b>COMANDOS DISPONIBLES</b>
 
 🔍 <b>COMANDOS DE BÚSQUEDA:</b>
 /live &lt;palabra&gt; - Busca en el canal
-   Costo: {db.get_price()} créditos por búsqueda
+   Costo: {price} créditos por búsqueda
    Ejemplo: /live python
 
 👤 <b>COMANDOS DE USUARIO:</b>
@@ -306,14 +406,15 @@ async def cmds(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /cmds - Ver este menú de comandos
 
 💬 <b>TU INFORMACIÓN ACTUAL:</b>
-🔑 ID: <code>{user_id}</code>
-👤 Usuario: @{user['username']}
-💳 Créditos: {user['credits']}
-📅 Acceso hasta: {datetime.fromisoformat(str(user['expiry_date'])).strftime('%d/%m/%Y')}
+🔑 ID: <code>{user.user_id}</code>
+👤 Usuario: @{user.username}
+💳 Créditos: {user.credits}
+📅 Acceso hasta: {user.expiry_date:%d/%m/%Y}
 
-{"✅ Estado: ACTIVO" if user['is_active'] else "❌ Estado: INACTIVO"}
+{status}
+"""
 
-{"" if user_id != ADMIN_ID else f"""
+CMDS_ADMIN_SUFFIX = """
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 ⚙️ <b>COMANDOS ADMIN:</b>
 /adduser &lt;id&gt; &lt;créditos&gt; &lt;días&gt; - Agregar usuario
@@ -329,15 +430,123 @@ async def cmds(update: Update, context: ContextTypes.DEFAULT_TYPE):
    Ejemplo: /addcredits 123456789 50
 
 /stats - Ver estadísticas del sistema
-"""}
-    """
+"""
+
+CREDITOS_TEMPLATE = """
+💳 <b>TUS CRÉDITOS</b>
+
+💰 Créditos disponibles: <b>{user.credits}</b>
+🔍 Búsquedas disponibles: <b>{searches_available}</b>
+💵 Costo por búsqueda: <b>{price} créditos</b>
+
+{status}
+
+Usa /live &lt;palabra&gt; para buscar
+"""
+
+PERFIL_TEMPLATE = """
+👤 <b>TU PERFIL</b>
+
+🔑 ID Telegram: <code>{user.user_id}</code>
+👤 Usuario: <b>@{user.username}</b>
+📝 Nombre: <b>{user.first_name} {user.last_name}</b>
+💳 Créditos: <b>{user.credits}</b>
+📅 Acceso expira en: <b>{dias_restantes} días</b>
+📆 Fecha expiración: {user.expiry_date:%d/%m/%Y %H:%M}
+📝 Miembro desde: {user.created_at:%d/%m/%Y}
+✅ Estado: <b>{status}</b>
+"""
+
+SEARCH_RESULT_TEMPLATE = """
+✅ <b>Búsqueda Completada</b>
+
+🔍 Término: <b>{search_term}</b>
+📍 Resultados: Se está procesando...
+💳 Créditos usados: <b>{price}</b>
+💰 Créditos restantes: <b>{remaining_credits}</b>
+
+Puedes hacer {searches_available} búsquedas más con tus créditos actuales.
+"""
+
+# ==================== COMANDOS DE USUARIO ====================
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /start - Registro automático y bienvenida"""
+    user = update.effective_user
+    user_id = user.id
+    username = user.username or "Sin usuario"
+    first_name = user.first_name or "Usuario"
+    last_name = user.last_name or ""
+
+    # Registrar al usuario si es nuevo (un solo upsert)
+    user_info, was_inserted = await db.touch_user(
+        user_id=user_id,
+        username=username,
+        first_name=first_name,
+        last_name=last_name,
+        credits=INITIAL_CREDITS,
+        days=30
+    )
+
+    if was_inserted:
+        # Mensaje de bienvenida para nuevo usuario
+        welcome_msg = WELCOME_NEW_TEMPLATE.format(
+            first_name=first_name,
+            user_id=user_id,
+            username=username,
+            credits=INITIAL_CREDITS,
+            days=30
+        )
+    else:
+        # Usuario ya existe
+        if not user_info.is_active:
+            await update.message.reply_text(
+                "❌ Tu acceso ha sido desactivado.\n"
+                "Contacta al administrador.",
+                parse_mode=ParseMode.HTML
+            )
+            return
+
+        if datetime.now() > user_info.expiry_date:
+            await update.message.reply_text(
+                "⏰ Tu acceso ha expirado.\n"
+                "Contacta al administrador para renovar.",
+                parse_mode=ParseMode.HTML
+            )
+            return
+
+        welcome_msg = WELCOME_BACK_TEMPLATE.format(first_name=first_name, user=user_info)
+
+    await update.message.reply_text(welcome_msg, parse_mode=ParseMode.HTML)
+
+async def cmds(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /cmds - Muestra todos los comandos disponibles"""
+    user_id = update.effective_user.id
+    user = await db.get_user(user_id)
+
+    if not user:
+        await update.message.reply_text(
+            "❌ No estás registrado. Usa /start primero.",
+            parse_mode=ParseMode.HTML
+        )
+        return
+
+    price = await db.get_price()
+
+    commands_msg = CMDS_TEMPLATE.format(
+        price=price,
+        user=user,
+        status="✅ Estado: ACTIVO" if user.is_active else "❌ Estado: INACTIVO"
+    )
+    if user_id == ADMIN_ID:
+        commands_msg += CMDS_ADMIN_SUFFIX
 
     await update.message.reply_text(commands_msg, parse_mode=ParseMode.HTML)
 
 async def creditos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando /creditos - Ver créditos disponibles"""
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
 
     if not user:
         await update.message.reply_text(
@@ -346,27 +555,25 @@ async def creditos(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    price = db.get_price()
-    searches_available = user['credits'] // price
-
-    creditos_msg = f"""
-💳 <b>TUS CRÉDITOS</b>
-
-💰 Créditos disponibles: <b>{user['credits']}</b>
-🔍 Búsquedas disponibles: <b>{searches_available}</b>
-💵 Costo por búsqueda: <b>{price} créditos</b>
-
-{"✅ Tienes suficientes créditos para buscar" if searches_available > 0 else "❌ Insuficientes créditos. Contacta al admin"}
+    price = await db.get_price()
+    searches_available = user.credits // price
 
-Usa /live &lt;palabra&gt; para buscar
-    """
+    creditos_msg = CREDITOS_TEMPLATE.format(
+        user=user,
+        searches_available=searches_available,
+        price=price,
+        status=(
+            "✅ Tienes suficientes créditos para buscar" if searches_available > 0
+            else "❌ Insuficientes créditos. Contacta al admin"
+        )
+    )
 
     await update.message.reply_text(creditos_msg, parse_mode=ParseMode.HTML)
 
 async def perfil(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando /perfil - Ver información del usuario"""
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
 
     if not user:
         await update.message.reply_text(
@@ -375,103 +582,89 @@ async def perfil(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    expiry = datetime.fromisoformat(str(user['expiry_date']))
-    dias_restantes = (expiry - datetime.now()).days
-
-    perfil_msg = f"""
-👤 <b>TU PERFIL</b>
+    dias_restantes = (user.expiry_date - datetime.now()).days
 
-🔑 ID Telegram: <code>{user_id}</code>
-👤 Usuario: <b>@{user['username']}</b>
-📝 Nombre: <b>{user['first_name']} {user['last_name']}</b>
-💳 Créditos: <b>{user['credits']}</b>
-📅 Acceso expira en: <b>{dias_restantes} días</b>
-📆 Fecha expiración: {expiry.strftime('%d/%m/%Y %H:%M')}
-📝 Miembro desde: {datetime.fromisoformat(str(user['created_at'])).strftime('%d/%m/%Y')}
-✅ Estado: <b>{"ACTIVO" if user['is_active'] else "INACTIVO"}</b>
-    """
+    perfil_msg = PERFIL_TEMPLATE.format(
+        user=user,
+        dias_restantes=dias_restantes,
+        status="ACTIVO" if user.is_active else "INACTIVO"
+    )
 
     await update.message.reply_text(perfil_msg, parse_mode=ParseMode.HTML)
 
 async def live_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando /live - Buscar en el canal"""
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
 
-    if not user:
+    if not context.args:
+        await update.message.reply_text(
+            "❌ Uso correcto: /live &lt;palabra clave&gt;\n"
+            "Ejemplo: /live python",
+            parse_mode=ParseMode.HTML
+        )
+        return
+
+    search_term = ' '.join(context.args)
+
+    # Verifica acceso y cobra en una sola consulta
+    charged = await db.charge_search(user_id, search_term, 0)
+
+    if not charged:
         await update.message.reply_text(
             "❌ No estás registrado. Usa /start",
             parse_mode=ParseMode.HTML
         )
         return
 
-    if not user['is_active']:
+    status, credits, price = charged
+
+    if status == 'inactive':
         await update.message.reply_text(
             "❌ Tu acceso ha sido desactivado.",
             parse_mode=ParseMode.HTML
         )
         return
 
-    expiry = datetime.fromisoformat(str(user['expiry_date']))
-    if datetime.now() > expiry:
+    if status == 'expired':
         await update.message.reply_text(
             "⏰ Tu acceso ha expirado. Contacta al administrador.",
             parse_mode=ParseMode.HTML
         )
         return
 
-    price = db.get_price()
-    if user['credits'] < price:
+    if status == 'nofunds':
         await update.message.reply_text(
             f"❌ Créditos insuficientes.\n"
             f"Necesitas: {price} créditos\n"
-            f"Tienes: {user['credits']} créditos\n\n"
+            f"Tienes: {credits} créditos\n\n"
             f"Contacta al administrador para agregar créditos.",
             parse_mode=ParseMode.HTML
         )
         return
 
-    if not context.args:
+    try:
+        # Ya se cobró: si este aviso falla (flood control, bot bloqueado...) también se devuelve
         await update.message.reply_text(
-            "❌ Uso correcto: /live &lt;palabra clave&gt;\n"
-            "Ejemplo: /live python",
+            f"🔍 Buscando '{search_term}' en el canal...",
             parse_mode=ParseMode.HTML
         )
-        return
-
-    search_term = ' '.join(context.args)
-
-    await update.message.reply_text(
-        f"🔍 Buscando '{search_term}' en el canal...",
-        parse_mode=ParseMode.HTML
-    )
 
-    try:
         # Aquí irá la lógica para buscar en el canal
         # Por ahora simulamos la búsqueda
-        
-        db.deduct_credits(user_id, price)
-        db.log_search(user_id, search_term, 0)
-
-        remaining_credits = user['credits'] - price
-
-        search_result = f"""
-✅ <b>Búsqueda Completada</b>
-
-🔍 Término: <b>{search_term}</b>
-📍 Resultados: Se está procesando...
-💳 Créditos usados: <b>{price}</b>
-💰 Créditos restantes: <b>{remaining_credits}</b>
 
-Puedes hacer {remaining_credits // price} búsquedas más con tus créditos actuales.
-        """
+        search_result = SEARCH_RESULT_TEMPLATE.format(
+            search_term=search_term,
+            price=price,
+            remaining_credits=credits,
+            searches_available=credits // price
+        )
 
         await update.message.reply_text(search_result, parse_mode=ParseMode.HTML)
 
     except Exception as e:
         logger.error(f"Error en búsqueda: {e}")
         # Devolver créditos en caso de error
-        db.add_credits(user_id, price)
+        await db.add_credits(user_id, price)
         await update.message.reply_text(
             f"❌ Error en la búsqueda: {str(e)}",
             parse_mode=ParseMode.HTML
@@ -479,6 +672,18 @@ Puedes hacer {remaining_credits // price} búsquedas más con tus créditos actu
 
 # ==================== COMANDOS ADMIN ====================
 
+# Los updates se procesan en paralelo; los comandos admin se ejecutan de a uno
+ADMIN_LOCK = asyncio.Lock()
+
+def serialized(handler):
+    """Ejecuta el handler bajo ADMIN_LOCK"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with ADMIN_LOCK:
+            return await handler(update, context)
+    return wrapper
+
+@serialized
 async def adduser(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando /adduser - Agregar usuario (SOLO ADMIN)"""
     if update.effective_user.id != ADMIN_ID:
@@ -501,7 +706,7 @@ async def adduser(update: Update, context: ContextTypes.DEFAULT_TYPE):
         credits = int(context.args[1])
         days = int(context.args[2])
 
-        db.register_user(
+        user = await db.register_user(
             user_id=user_id,
             username=f"user_{user_id}",
             first_name="Agregado",
@@ -510,10 +715,17 @@ async def adduser(update: Update, context: ContextTypes.DEFAULT_TYPE):
             days=days
         )
 
+        if not user:
+            await update.message.reply_text(
+                "❌ No se pudo agregar el usuario.",
+                parse_mode=ParseMode.HTML
+            )
+            return
+
         await update.message.reply_text(
             f"✅ <b>Usuario Agregado</b>\n"
             f"🔑 ID: <code>{user_id}</code>\n"
-            f"💳 Créditos: {credits}\n"
+            f"💳 Créditos: {user.credits}\n"
             f"📅 Acceso: {days} días",
             parse_mode=ParseMode.HTML
         )
@@ -524,6 +736,7 @@ async def adduser(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode=ParseMode.HTML
         )
 
+@serialized
 async def removeuser(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando /removeuser - Eliminar usuario (SOLO ADMIN)"""
     if update.effective_user.id != ADMIN_ID:
@@ -542,7 +755,7 @@ async def removeuser(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         user_id = int(context.args[0])
-        db.remove_user(user_id)
+        await db.remove_user(user_id)
         await update.message.reply_text(
             f"✅ Usuario {user_id} desactivado.",
             parse_mode=ParseMode.HTML
@@ -553,6 +766,7 @@ async def removeuser(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode=ParseMode.HTML
         )
 
+@serialized
 async def setprice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando /setprice - Cambiar precio (SOLO ADMIN)"""
     if update.effective_user.id != ADMIN_ID:
@@ -571,7 +785,7 @@ async def setprice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         new_price = int(context.args[0])
-        db.set_price(new_price)
+        await db.set_price(new_price)
         await update.message.reply_text(
             f"✅ Precio actualizado a {new_price} créditos por búsqueda.",
             parse_mode=ParseMode.HTML
@@ -582,6 +796,7 @@ async def setprice(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode=ParseMode.HTML
         )
 
+@serialized
 async def addcredits(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando /addcredits - Agregar créditos (SOLO ADMIN)"""
     if update.effective_user.id != ADMIN_ID:
@@ -601,11 +816,17 @@ async def addcredits(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = int(context.args[0])
         amount = int(context.args[1])
-        db.add_credits(user_id, amount)
-        user = db.get_user(user_id)
+        credits = await db.add_credits(user_id, amount)
+        if credits is None:
+            await update.message.reply_text(
+                f"❌ Usuario {user_id} no encontrado.",
+                parse_mode=ParseMode.HTML
+            )
+            return
+
         await update.message.reply_text(
             f"✅ Se agregaron {amount} créditos a usuario {user_id}\n"
-            f"Créditos actuales: {user['credits']}",
+            f"Créditos actuales: {credits}",
             parse_mode=ParseMode.HTML
         )
     except ValueError:
@@ -614,6 +835,7 @@ async def addcredits(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode=ParseMode.HTML
         )
 
+@serialized
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Comando /stats - Ver estadísticas (SOLO ADMIN)"""
     if update.effective_user.id != ADMIN_ID:
@@ -623,8 +845,8 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    user_count, search_count = db.get_stats()
-    price = db.get_price()
+    user_count, search_count = await db.get_stats()
+    price = await db.get_price()
 
     stats_msg = f"""
 📊 <b>ESTADÍSTICAS DEL SISTEMA</b>
@@ -640,9 +862,28 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ==================== MAIN ====================
 
+async def post_init(application: Application):
+    """Abre el pool de la base de datos antes de recibir updates"""
+    await db.open()
+
+async def post_shutdown(application: Application):
+    """Cierra el pool de la base de datos al apagar el bot"""
+    await db.close()
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Registra los errores no capturados en los handlers (p. ej. PoolTimeout)"""
+    logger.error("Error procesando update", exc_info=context.error)
+
 def main():
     """Inicia el bot"""
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(DB_POOL_SIZE)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Comandos de usuario
     app.add_handler(CommandHandler('start', start))
@@ -651,13 +892,15 @@ def main():
     app.add_handler(CommandHandler('perfil', perfil))
     app.add_handler(CommandHandler('live', live_search))
 
-    # Comandos admin
+    # Comandos admin (serializados con ADMIN_LOCK)
     app.add_handler(CommandHandler('adduser', adduser))
     app.add_handler(CommandHandler('removeuser', removeuser))
     app.add_handler(CommandHandler('setprice', setprice))
     app.add_handler(CommandHandler('addcredits', addcredits))
     app.add_handler(CommandHandler('stats', stats))
 
+    app.add_error_handler(error_handler)
+
     logger.info("=" * 50)
     logger.info("🤖 Bot Telegram iniciado correctamente")
     logger.info("=" * 50)